@@ -1,66 +1,315 @@
+import asyncio
+import functools
+import hashlib
+import json
 import os
 import io
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# upb is already the default backend for protobuf>=4.21 (we require >=4.25), so this only
+# documents intent; it must still come before the first protobuf import to have any effect
+os.environ.setdefault('PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION', 'upb')
+
+import diskcache
 from dotenv import load_dotenv
+import google.auth
+import google.auth.transport.requests
+import grpc
+from google.api_core.client_options import ClientOptions
 from google.cloud import vision
-from PIL import Image
+from google.cloud.vision_v1.services.image_annotator.transports import ImageAnnotatorGrpcTransport
+from google.protobuf.internal import api_implementation
+from PIL import Image, ImageOps
 
 load_dotenv()
 
+if api_implementation.Type() == 'python':
+    print("Warning: protobuf is using the pure-Python backend, Vision responses will parse slowly")
+
+VISION_API_ENDPOINT = 'vision.googleapis.com'
+
+# Passing our own channel replaces the transport's defaults, so keep its unlimited
+# message sizes (batch responses with text detection exceed gRPC's 4MB default)
+# and add keepalive pings so the HTTP/2 connection survives between calls
+GRPC_CHANNEL_OPTIONS = [
+    ('grpc.max_send_message_length', -1),
+    ('grpc.max_receive_message_length', -1),
+    ('grpc.keepalive_time_ms', 30000),
+]
+
+# Images are read and hashed in chunks of this many bytes
+READ_CHUNK_SIZE = 1 << 20
+
+# Seconds the background warmup waits for the gRPC channel to connect
+WARMUP_TIMEOUT = 10
+
+# Number of analysis results kept in the in-memory LRU cache
+MEMORY_CACHE_SIZE = 512
+
+# Directory for the persistent result cache
+DISK_CACHE_DIR = os.getenv('VISION_CACHE_DIR', './.vision_cache')
+
+# Bump whenever the shape or content of cached results changes (features, sections,
+# preprocessing, dict keys) so entries written by older code are never served
+CACHE_VERSION = 1
+
+# Upper bound on in-flight async requests to stay within Vision QPS limits
+ASYNC_CONCURRENCY = 32
+
+# Concurrent workers for the file read and Vision RPC stages of analyze_pipeline
+PIPELINE_READ_WORKERS = 8
+PIPELINE_RPC_WORKERS = 16
+
+# Images held in each of the read -> resize and resize -> RPC queues of analyze_pipeline
+PIPELINE_BUFFER_SIZE = 16
+
+# Images are downscaled so their longest edge is at most this many pixels
+PREPARE_MAX_EDGE = 1024
+
+# Files smaller than this are sent to Vision as-is
+PREPARE_MIN_BYTES = 200 * 1024
+
+# Number of prepared images kept so repeated analyses of a file skip decode + resize
+PREPARED_CACHE_SIZE = 256
+
+# Vision accepts at most 16 images per batch_annotate_images call
+BATCH_SIZE = 16
+
+# Vision accepts at most 2000 images per async_batch_annotate_images operation
+OFFLINE_BATCH_SIZE = 2000
+
+# Responses written per JSON output file by offline indexing
+OFFLINE_OUTPUT_BATCH_SIZE = 100
+
+# Longest time (seconds) an async request waits for others to share its batch
+BATCH_WINDOW = 0.025
+
+# Features requested for the comprehensive analysis of a single image
+DETAILED_FEATURES = [
+    vision.Feature(type_=vision.Feature.Type.LABEL_DETECTION, max_results=10),
+    vision.Feature(type_=vision.Feature.Type.OBJECT_LOCALIZATION, max_results=10),
+    vision.Feature(type_=vision.Feature.Type.TEXT_DETECTION, max_results=1),
+    vision.Feature(type_=vision.Feature.Type.LANDMARK_DETECTION, max_results=5),
+    vision.Feature(type_=vision.Feature.Type.LOGO_DETECTION, max_results=5),
+    vision.Feature(type_=vision.Feature.Type.IMAGE_PROPERTIES),
+]
+
+# Response sections walked by _extract_objects_from_response for each caller
+DETAILED_SECTIONS = frozenset({'labels', 'objects'})
+TAGGING_SECTIONS = frozenset({'labels', 'objects', 'landmarks', 'logos'})
+
+
+class VisionUnavailable(RuntimeError):
+    """Raised when no Google Vision client can be created"""
+
+
+class IndexingError(RuntimeError):
+    """Raised when index_library could not start every operation.
+    
+    operations holds the operations that did start (their results still land in
+    GCS); unsubmitted_uris holds the URIs that were never sent.
+    """
+    
+    def __init__(self, operations, unsubmitted_uris, error):
+        super().__init__(f'{len(unsubmitted_uris)} images were not submitted for indexing: {error}')
+        self.operations = operations
+        self.unsubmitted_uris = unsubmitted_uris
+
+
+def fallback_analysis():
+    """Analysis to use when Vision is unavailable or the call fails"""
+    return {
+        'alt_text': 'Image uploaded by user',
+        'objects': [],
+        'colors': [],
+        'text': ''
+    }
+
+
+_client = None
+_credentials = None
+_client_error = None
+_client_lock = threading.Lock()
+
+
+def _require_credentials():
+    """Raise VisionUnavailable unless Google credentials are configured"""
+    if not os.getenv('GOOGLE_APPLICATION_CREDENTIALS'):
+        raise VisionUnavailable('Google credentials not found')
+
+
+def _build_client():
+    """Create the sync Vision client on a keepalive-enabled gRPC channel.
+    
+    Returns the client and the credentials its channel authenticates with.
+    """
+    _require_credentials()
+    try:
+        credentials, _ = google.auth.default(scopes=ImageAnnotatorGrpcTransport.AUTH_SCOPES)
+        channel = ImageAnnotatorGrpcTransport.create_channel(
+            f'{VISION_API_ENDPOINT}:443',
+            credentials=credentials,
+            options=GRPC_CHANNEL_OPTIONS
+        )
+        client = vision.ImageAnnotatorClient(
+            client_options=ClientOptions(api_endpoint=VISION_API_ENDPOINT),
+            transport=ImageAnnotatorGrpcTransport(host=VISION_API_ENDPOINT, channel=channel)
+        )
+    except Exception as e:
+        raise VisionUnavailable(f'Error initializing Google Vision client: {e}') from e
+    return client, credentials
+
+
+def _get_shared_client():
+    """Build the Vision client on first use and share it across threads.
+    
+    Building lazily (rather than at import) and resetting after fork means each
+    forked server worker opens its own channel instead of inheriting the
+    parent's. A failed build is remembered for the life of the process, so
+    later calls raise without retrying.
+    """
+    global _client, _credentials, _client_error
+    if _client is None:
+        with _client_lock:
+            if _client is None and _client_error is None:
+                try:
+                    _client, _credentials = _build_client()
+                except VisionUnavailable as e:
+                    _client_error = str(e)
+        if _client is None:
+            raise VisionUnavailable(_client_error)
+    return _client
+
+
+def _reset_shared_client():
+    """Drop the client inherited from the parent process (gRPC channels aren't fork-safe)"""
+    global _client, _credentials, _client_error, _client_lock
+    _client = None
+    _credentials = None
+    _client_error = None
+    _client_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_shared_client)
+
+
+class _BatchScheduler:
+    """Coalesces async annotate requests into batch_annotate_images calls.
+    
+    A batch is sent once it holds BATCH_SIZE requests or BATCH_WINDOW seconds
+    after its first request arrived, whichever comes first.
+    """
+    
+    def __init__(self, client, max_batch_size=BATCH_SIZE, max_wait=BATCH_WINDOW):
+        self.client = client
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._worker = None
+        self._in_flight = set()
+    
+    async def submit(self, request):
+        """Queue a request and wait for its AnnotateImageResponse"""
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._collect())
+        future = self.loop.create_future()
+        await self._queue.put((request, future))
+        return await future
+    
+    async def _collect(self):
+        while True:
+            batch = [await self._queue.get()]
+            deadline = self.loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - self.loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            # Send in the background so the next batch can start filling
+            task = asyncio.create_task(self._dispatch(batch))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+    
+    async def _dispatch(self, batch):
+        batch = [(request, future) for request, future in batch if not future.cancelled()]
+        if not batch:
+            return
+        
+        try:
+            batch_response = await self.client.batch_annotate_images(
+                requests=[request for request, _ in batch]
+            )
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        
+        for (_, future), response in zip(batch, batch_response.responses):
+            if future.done():
+                continue
+            if response.error.message:
+                future.set_exception(RuntimeError(response.error.message))
+            else:
+                future.set_result(response)
+
+
 class MLService:
-    def __init__(self):
-        # Set credentials path
-        credentials_path = os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
-        if credentials_path:
-            os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = credentials_path
-            try:
-                self.client = vision.ImageAnnotatorClient()
-            except Exception as e:
-                print(f"Error initializing Google Vision client: {e}")
-                self.client = None
-        else:
-            print("Google credentials not found")
-            self.client = None
+    def __init__(self, cache_dir=DISK_CACHE_DIR):
+        # Built lazily so its gRPC channel binds to the event loop that uses it
+        self.async_client = None
+        self._async_client_loop = None
+        self._batch_scheduler = None
+        
+        # Results keyed by image content hash + requested features; cache_dir=None
+        # keeps them in memory only
+        self._mem_cache = OrderedDict()
+        self._mem_cache_lock = threading.Lock()
+        self._disk_cache = diskcache.Cache(cache_dir) if cache_dir else None
+        
+        # Prepared (resized) bytes keyed by path, mtime and size
+        self._prepared_cache = functools.lru_cache(maxsize=PREPARED_CACHE_SIZE)(self._load_prepared)
+    
+    @property
+    def client(self):
+        """Vision client shared by every MLService in this process.
+        
+        Raises VisionUnavailable when Vision is not configured; callers choose
+        the fallback (see fallback_analysis).
+        """
+        return _get_shared_client()
     
     def generate_alt_text(self, image_path):
         """Generate alternative text for an image using Google Vision"""
-        if not self.client:
-            return "Image uploaded by user"
+        client = self.client
         
         try:
-            # Read image file
-            with io.open(image_path, 'rb') as image_file:
-                content = image_file.read()
+            content, _ = self._prepare_content(image_path)
             
             image = vision.Image(content=content)
             
-            # Get image description
-            response = self.client.label_detection(image=image)
-            labels = response.label_annotations
-            
-            # Also try to get a better description using landmark or logo detection
-            landmark_response = self.client.landmark_detection(image=image)
-            landmarks = landmark_response.landmark_annotations
-            
-            # Try to get text in image
-            text_response = self.client.text_detection(image=image)
-            texts = text_response.text_annotations
-            
-            # Build alt text
-            alt_text_parts = []
+            # Request labels and landmarks in a single round-trip
+            features = [
+                vision.Feature(type_=vision.Feature.Type.LABEL_DETECTION, max_results=3),
+                vision.Feature(type_=vision.Feature.Type.LANDMARK_DETECTION, max_results=1),
+            ]
             
-            if landmarks:
-                alt_text_parts.append(landmarks[0].description)
+            request = vision.AnnotateImageRequest(
+                image=image,
+                features=features
+            )
             
-            if labels and len(labels) > 0:
-                # Use top 3 labels for description
-                top_labels = [label.description for label in labels[:3]]
-                if not landmarks:
-                    alt_text_parts.append("Image containing " + ", ".join(top_labels))
+            response = client.annotate_image(request)
             
-            if alt_text_parts:
-                return ". ".join(alt_text_parts)
-            else:
-                return "Image uploaded by user"
+            return self._build_alt_text_from_response(response)
                 
         except Exception as e:
             print(f"Error generating alt text: {e}")
@@ -68,50 +317,29 @@ class MLService:
     
     def detect_objects(self, image_path):
         """Detect objects in image for search using Google Vision"""
-        if not self.client:
-            return []
+        client = self.client
         
         try:
-            # Read image file
-            with io.open(image_path, 'rb') as image_file:
-                content = image_file.read()
+            content, _ = self._prepare_content(image_path)
             
             image = vision.Image(content=content)
             
-            # Collect all possible objects/tags
-            objects = []
-            
-            # Get labels (general objects)
-            response = self.client.label_detection(image=image, max_results=10)
-            for label in response.label_annotations:
-                if label.score > 0.5:  # Confidence threshold
-                    objects.append(label.description.lower())
-            
-            # Get objects (specific object detection)
-            object_response = self.client.object_localization(image=image)
-            for obj in object_response.localized_object_annotations:
-                if obj.score > 0.5:
-                    objects.append(obj.name.lower())
-            
-            # Get landmarks
-            landmark_response = self.client.landmark_detection(image=image)
-            for landmark in landmark_response.landmark_annotations:
-                objects.append(landmark.description.lower())
+            # Request every detection used for tagging in a single round-trip
+            features = [
+                vision.Feature(type_=vision.Feature.Type.LABEL_DETECTION, max_results=10),
+                vision.Feature(type_=vision.Feature.Type.OBJECT_LOCALIZATION),
+                vision.Feature(type_=vision.Feature.Type.LANDMARK_DETECTION),
+                vision.Feature(type_=vision.Feature.Type.LOGO_DETECTION),
+            ]
             
-            # Get logos
-            logo_response = self.client.logo_detection(image=image)
-            for logo in logo_response.logo_annotations:
-                objects.append(logo.description.lower())
+            request = vision.AnnotateImageRequest(
+                image=image,
+                features=features
+            )
             
-            # Remove duplicates while preserving order
-            seen = set()
-            unique_objects = []
-            for obj in objects:
-                if obj not in seen:
-                    seen.add(obj)
-                    unique_objects.append(obj)
+            response = client.annotate_image(request)
             
-            return unique_objects
+            return self._extract_objects_from_response(response, TAGGING_SECTIONS)
             
         except Exception as e:
             print(f"Error detecting objects: {e}")
@@ -119,55 +347,391 @@ class MLService:
     
     def get_detailed_analysis(self, image_path):
         """Get comprehensive image analysis for better search and alt text"""
-        if not self.client:
-            return {
-                'alt_text': 'Image uploaded by user',
-                'objects': [],
-                'colors': [],
-                'text': ''
-            }
+        client = self.client
         
         try:
-            with io.open(image_path, 'rb') as image_file:
-                content = image_file.read()
+            content, digest = self._prepare_content(image_path)
+            
+            key = self._cache_key(digest, DETAILED_FEATURES)
+            cached = self._cache_get(key)
+            if cached is not None:
+                return cached
             
             image = vision.Image(content=content)
             
             # Perform multiple detections in one call for efficiency
-            features = [
-                vision.Feature(type_=vision.Feature.Type.LABEL_DETECTION, max_results=10),
-                vision.Feature(type_=vision.Feature.Type.OBJECT_LOCALIZATION, max_results=10),
-                vision.Feature(type_=vision.Feature.Type.TEXT_DETECTION, max_results=1),
-                vision.Feature(type_=vision.Feature.Type.LANDMARK_DETECTION, max_results=5),
-                vision.Feature(type_=vision.Feature.Type.LOGO_DETECTION, max_results=5),
-                vision.Feature(type_=vision.Feature.Type.IMAGE_PROPERTIES),
-            ]
+            request = vision.AnnotateImageRequest(
+                image=image,
+                features=DETAILED_FEATURES
+            )
+            
+            response = client.annotate_image(request)
+            
+            result = self._build_analysis_from_response(response)
+            self._cache_set(key, result)
+            return result
+            
+        except Exception as e:
+            print(f"Error in detailed analysis: {e}")
+            return fallback_analysis()
+    
+    def analyze_gcs(self, gcs_uri):
+        """Get detailed analysis for an image already stored in Cloud Storage.
+        
+        Vision fetches the image itself from the gs:// URI, so no bytes are uploaded.
+        """
+        client = self.client
+        
+        try:
+            image = vision.Image(source=vision.ImageSource(image_uri=gcs_uri))
             
             request = vision.AnnotateImageRequest(
                 image=image,
-                features=features
+                features=DETAILED_FEATURES
             )
             
-            response = self.client.annotate_image(request)
+            response = client.annotate_image(request)
+            
+            return self._build_analysis_from_response(response)
+            
+        except Exception as e:
+            print(f"Error in GCS analysis: {e}")
+            return fallback_analysis()
+    
+    def analyze_batch(self, image_paths):
+        """Get detailed analysis for many images, 16 per batch_annotate_images call"""
+        image_paths = list(image_paths)
+        client = self.client
+        
+        results = {}
+        with ThreadPoolExecutor() as executor:
+            prepared = list(executor.map(self._try_prepare_content, image_paths))
+        
+        # Only send images that could be read and whose results are not cached yet
+        pending = []
+        for path, item in zip(image_paths, prepared):
+            if item is None:
+                continue
+            content, digest = item
+            key = self._cache_key(digest, DETAILED_FEATURES)
+            cached = self._cache_get(key)
+            if cached is not None:
+                results[path] = cached
+            else:
+                pending.append((path, key, content))
+        
+        for start in range(0, len(pending), BATCH_SIZE):
+            chunk = pending[start:start + BATCH_SIZE]
+            requests = [
+                vision.AnnotateImageRequest(
+                    image=vision.Image(content=content),
+                    features=DETAILED_FEATURES
+                )
+                for _, _, content in chunk
+            ]
+            try:
+                batch_response = client.batch_annotate_images(requests=requests)
+            except Exception as e:
+                print(f"Error in batch analysis: {e}")
+                continue
+            for (path, key, _), response in zip(chunk, batch_response.responses):
+                if response.error.message:
+                    print(f"Error in batch analysis of {path}: {response.error.message}")
+                else:
+                    results[path] = self._build_analysis_from_response(response)
+                    self._cache_set(key, results[path])
+        
+        # Anything not analyzed (unreadable file, failed image or chunk) gets the fallback
+        for path in image_paths:
+            results.setdefault(path, fallback_analysis())
+        
+        return results
+    
+    async def get_detailed_analysis_async(self, image_path):
+        """Async variant of get_detailed_analysis for concurrent callers"""
+        scheduler = self._get_batch_scheduler()
+        
+        try:
+            # Read and resize off the event loop so other analyses keep running
+            content, digest = await asyncio.to_thread(self._prepare_content, image_path)
+            
+            key = self._cache_key(digest, DETAILED_FEATURES)
+            cached = self._cache_get(key)
+            if cached is not None:
+                return cached
+            
+            request = vision.AnnotateImageRequest(
+                image=vision.Image(content=content),
+                features=DETAILED_FEATURES
+            )
             
-            # Process results
-            result = {
-                'alt_text': self._build_alt_text_from_response(response),
-                'objects': self._extract_objects_from_response(response),
-                'dominant_colors': self._extract_colors_from_response(response),
-                'text': response.text_annotations[0].description if response.text_annotations else ''
-            }
+            # Coalesced with concurrent requests into one batch_annotate_images call
+            response = await scheduler.submit(request)
             
+            result = self._build_analysis_from_response(response)
+            self._cache_set(key, result)
             return result
             
         except Exception as e:
-            print(f"Error in detailed analysis: {e}")
-            return {
-                'alt_text': 'Image uploaded by user',
-                'objects': [],
-                'colors': [],
-                'text': ''
-            }
+            print(f"Error in async detailed analysis: {e}")
+            return fallback_analysis()
+    
+    async def analyze_many(self, image_paths):
+        """Analyze many images concurrently, returning results in input order"""
+        semaphore = asyncio.Semaphore(ASYNC_CONCURRENCY)
+        
+        async def analyze(path):
+            async with semaphore:
+                return await self.get_detailed_analysis_async(path)
+        
+        return await asyncio.gather(*[analyze(path) for path in image_paths])
+    
+    async def analyze_pipeline(self, image_paths):
+        """Analyze many images through staged read, resize, RPC and postprocess workers"""
+        image_paths = list(image_paths)
+        client = self._get_async_client()
+        results = [fallback_analysis() for _ in image_paths]
+        
+        async def read(index, path):
+            return await asyncio.to_thread(self._read_image, path)
+        
+        async def resize(index, item):
+            raw, digest = item
+            # The key comes from the raw bytes, so cache hits skip the resize entirely
+            key = self._cache_key(digest, DETAILED_FEATURES)
+            cached = self._cache_get(key)
+            if cached is not None:
+                results[index] = cached
+                return None
+            content = await asyncio.to_thread(self._resize_content, raw)
+            return key, content
+        
+        async def annotate(index, item):
+            key, content = item
+            request = vision.AnnotateImageRequest(
+                image=vision.Image(content=content),
+                features=DETAILED_FEATURES
+            )
+            # The async client has no annotate_image helper, so send a batch of one
+            batch_response = await client.batch_annotate_images(requests=[request])
+            response = batch_response.responses[0]
+            if response.error.message:
+                raise RuntimeError(response.error.message)
+            return key, response
+        
+        async def postprocess(index, item):
+            key, response = item
+            results[index] = self._build_analysis_from_response(response)
+            self._cache_set(key, results[index])
+            return None
+        
+        # Bounded queues keep only a few images in memory between stages
+        path_q = asyncio.Queue()
+        read_q = asyncio.Queue(maxsize=PIPELINE_BUFFER_SIZE)
+        rpc_q = asyncio.Queue(maxsize=PIPELINE_BUFFER_SIZE)
+        post_q = asyncio.Queue()
+        stages = [
+            (path_q, read_q, read, PIPELINE_READ_WORKERS),
+            (read_q, rpc_q, resize, os.cpu_count() or 1),
+            (rpc_q, post_q, annotate, PIPELINE_RPC_WORKERS),
+            (post_q, None, postprocess, 1),
+        ]
+        
+        for item in enumerate(image_paths):
+            path_q.put_nowait(item)
+        
+        workers = [
+            asyncio.create_task(self._run_pipeline_stage(inbox, outbox, handle, results))
+            for inbox, outbox, handle, count in stages
+            for _ in range(count)
+        ]
+        try:
+            # Items only move downstream, so draining the stages in order drains the pipeline
+            for inbox, _, _, _ in stages:
+                await inbox.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+        
+        return results
+    
+    async def _run_pipeline_stage(self, inbox, outbox, handle, results):
+        """Helper to run one pipeline worker, leaving the fallback result on errors"""
+        while True:
+            index, item = await inbox.get()
+            try:
+                output = await handle(index, item)
+                if output is not None and outbox is not None:
+                    await outbox.put((index, output))
+            except Exception as e:
+                print(f"Error in analysis pipeline: {e}")
+                results[index] = fallback_analysis()
+            finally:
+                inbox.task_done()
+    
+    def start_warmup(self):
+        """Open the Vision channel and fetch an access token in the background.
+        
+        Called from the app factory; nothing here sends a Vision request. With
+        gunicorn --preload, call it again from a post_fork hook so each worker
+        warms its own channel.
+        """
+        threading.Thread(target=self._warmup, daemon=True).start()
+    
+    def _warmup(self):
+        """Helper to connect the channel and refresh credentials ahead of the first request"""
+        try:
+            client = self.client
+            _credentials.refresh(google.auth.transport.requests.Request())
+            grpc.channel_ready_future(client.transport.grpc_channel).result(timeout=WARMUP_TIMEOUT)
+        except Exception:
+            # Only the connection matters here; Vision being unavailable is
+            # reported by real calls instead
+            pass
+    
+    def _get_async_client(self):
+        """Helper to create the async Vision client for the running event loop"""
+        loop = asyncio.get_running_loop()
+        if self.async_client is None or self._async_client_loop is not loop:
+            _require_credentials()
+            try:
+                self.async_client = vision.ImageAnnotatorAsyncClient()
+            except Exception as e:
+                raise VisionUnavailable(f'Error initializing Google Vision async client: {e}') from e
+            self._async_client_loop = loop
+        return self.async_client
+    
+    def _get_batch_scheduler(self):
+        """Helper to get the batch scheduler for the running event loop"""
+        loop = asyncio.get_running_loop()
+        if self._batch_scheduler is None or self._batch_scheduler.loop is not loop:
+            self._batch_scheduler = _BatchScheduler(self._get_async_client())
+        return self._batch_scheduler
+    
+    def _cache_key(self, digest, features):
+        """Helper to key cached results by image content hash and requested features"""
+        feature_key = ','.join(f'{int(feature.type_)}:{feature.max_results}' for feature in features)
+        return f'v{CACHE_VERSION}:{digest}:{feature_key}'
+    
+    def _cache_get(self, key):
+        """Helper to look up a cached result, memory first then disk"""
+        with self._mem_cache_lock:
+            if key in self._mem_cache:
+                self._mem_cache.move_to_end(key)
+                return json.loads(self._mem_cache[key])
+        
+        if self._disk_cache is not None:
+            serialized = self._disk_cache.get(key)
+            if serialized is not None:
+                self._mem_cache_put(key, serialized)
+                return json.loads(serialized)
+        return None
+    
+    def _cache_set(self, key, result):
+        """Helper to store a result in both cache tiers"""
+        serialized = json.dumps(result)
+        self._mem_cache_put(key, serialized)
+        if self._disk_cache is not None:
+            self._disk_cache.set(key, serialized)
+    
+    def _mem_cache_put(self, key, serialized):
+        """Helper to insert into the in-memory LRU, evicting the oldest entry"""
+        with self._mem_cache_lock:
+            self._mem_cache[key] = serialized
+            self._mem_cache.move_to_end(key)
+            if len(self._mem_cache) > MEMORY_CACHE_SIZE:
+                self._mem_cache.popitem(last=False)
+    
+    def _prepare_content(self, image_path):
+        """Helper to get (downscaled image bytes, SHA-256 of the original file)"""
+        # mtime and size in the key make an overwritten file miss the cache
+        stat = os.stat(image_path)
+        return self._prepared_cache(image_path, stat.st_mtime_ns, stat.st_size)
+    
+    def _try_prepare_content(self, image_path):
+        """Helper for batch callers: _prepare_content, or None if the file can't be prepared"""
+        try:
+            return self._prepare_content(image_path)
+        except Exception as e:
+            print(f"Error preparing {image_path}: {e}")
+            return None
+    
+    def _load_prepared(self, image_path, mtime_ns, size):
+        """Helper behind the _prepare_content cache"""
+        content, digest = self._read_image(image_path)
+        return self._resize_content(content), digest
+    
+    def index_library(self, gcs_uris, output_uri):
+        """Start offline analysis of images in Cloud Storage as long-running operations.
+        
+        Each operation writes its JSON responses under its own prefix,
+        output_uri/batch-<n>/, since Vision numbers output files from 1 per
+        operation. Returns the started operations so the caller can poll them
+        (operation.result()) or watch the output bucket instead. If an operation
+        fails to start, raises IndexingError listing what was and wasn't submitted.
+        """
+        gcs_uris = list(gcs_uris)
+        client = self.client
+        output_prefix = output_uri.rstrip('/')
+        
+        operations = []
+        for batch_number, start in enumerate(range(0, len(gcs_uris), OFFLINE_BATCH_SIZE), 1):
+            requests = [
+                vision.AnnotateImageRequest(
+                    image=vision.Image(source=vision.ImageSource(image_uri=uri)),
+                    features=DETAILED_FEATURES
+                )
+                for uri in gcs_uris[start:start + OFFLINE_BATCH_SIZE]
+            ]
+            output_config = vision.OutputConfig(
+                gcs_destination=vision.GcsDestination(uri=f'{output_prefix}/batch-{batch_number}/'),
+                batch_size=OFFLINE_OUTPUT_BATCH_SIZE
+            )
+            try:
+                operations.append(
+                    client.async_batch_annotate_images(requests=requests, output_config=output_config)
+                )
+            except Exception as e:
+                raise IndexingError(operations, gcs_uris[start:], e) from e
+        
+        return operations
+    
+    def _read_image(self, image_path):
+        """Helper to read raw image bytes and hash them in the same pass"""
+        hasher = hashlib.sha256()
+        chunks = []
+        with io.open(image_path, 'rb') as image_file:
+            while chunk := image_file.read(READ_CHUNK_SIZE):
+                hasher.update(chunk)
+                chunks.append(chunk)
+        return b''.join(chunks), hasher.hexdigest()
+    
+    def _resize_content(self, content):
+        """Helper to shrink and re-encode image bytes as JPEG"""
+        if len(content) < PREPARE_MIN_BYTES:
+            return content
+        
+        with Image.open(io.BytesIO(content)) as img:
+            # Let the JPEG decoder downscale by DCT scaling instead of decoding full size
+            img.draft('RGB', (PREPARE_MAX_EDGE, PREPARE_MAX_EDGE))
+            # Re-encoding drops EXIF, so bake the orientation into the pixels
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((PREPARE_MAX_EDGE, PREPARE_MAX_EDGE), Image.LANCZOS)
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+            buffer = io.BytesIO()
+            img.save(buffer, format='JPEG', quality=85, optimize=True)
+        return buffer.getvalue()
+    
+    def _build_analysis_from_response(self, response):
+        """Helper to build the detailed analysis dict from API response"""
+        return {
+            'alt_text': self._build_alt_text_from_response(response),
+            'objects': self._extract_objects_from_response(response, DETAILED_SECTIONS),
+            'dominant_colors': self._extract_colors_from_response(response),
+            'text': response.text_annotations[0].description if response.text_annotations else ''
+        }
     
     def _build_alt_text_from_response(self, response):
         """Helper to build alt text from API response"""
@@ -181,17 +745,29 @@ class MLService:
         
         return ". ".join(parts) if parts else "Image uploaded by user"
     
-    def _extract_objects_from_response(self, response):
-        """Helper to extract all objects from API response"""
+    def _extract_objects_from_response(self, response, sections):
+        """Helper to extract objects from the requested sections of an API response"""
         objects = []
         
-        for label in response.label_annotations:
-            if label.score > 0.5:
-                objects.append(label.description.lower())
+        # Labels (general objects)
+        if 'labels' in sections:
+            for label in response.label_annotations:
+                if label.score > 0.5:  # Confidence threshold
+                    objects.append(label.description.lower())
         
-        for obj in response.localized_object_annotations:
-            if obj.score > 0.5:
-                objects.append(obj.name.lower())
+        # Objects (specific object detection)
+        if 'objects' in sections:
+            for obj in response.localized_object_annotations:
+                if obj.score > 0.5:
+                    objects.append(obj.name.lower())
+        
+        if 'landmarks' in sections:
+            for landmark in response.landmark_annotations:
+                objects.append(landmark.description.lower())
+        
+        if 'logos' in sections:
+            for logo in response.logo_annotations:
+                objects.append(logo.description.lower())
         
         return list(dict.fromkeys(objects))  # Remove duplicates
     
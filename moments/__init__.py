@@ -1,5 +1,7 @@
 from flask import Flask
 
+from ml_service import ml_service
+
 from moments.blueprints.admin import admin_bp
 from moments.blueprints.ajax import ajax_bp
 from moments.blueprints.auth import auth_bp
@@ -40,4 +42,7 @@ def create_app(config_name):
     register_request_handlers(app)
     register_error_handlers(app)
 
+    if app.config['MOMENTS_ML_PREWARM']:
+        ml_service.start_warmup()
+
     return app
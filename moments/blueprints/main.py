@@ -9,7 +9,7 @@ from moments.forms.main import CommentForm, DescriptionForm, TagForm
 from moments.models import Collection, Comment, Follow, Notification, Photo, Tag, User
 from moments.notifications import push_collect_notification, push_comment_notification
 from moments.utils import flash_errors, redirect_back, rename_image, resize_image, validate_image
-from ml_service import ml_service
+from ml_service import VisionUnavailable, fallback_analysis, ml_service
 import os 
 import json
 
@@ -151,7 +151,11 @@ def upload():
         
         # Process with ML service
         print(f"Processing image with ML: {file_path}")
-        analysis = ml_service.get_detailed_analysis(str(file_path))
+        try:
+            analysis = ml_service.get_detailed_analysis(str(file_path))
+        except VisionUnavailable as e:
+            print(f"ML service unavailable: {e}")
+            analysis = fallback_analysis()
         
         # Create photo with ML data
         photo = Photo(
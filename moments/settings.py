@@ -33,6 +33,7 @@ class BaseConfig:
         MOMENTS_PHOTO_SIZES['small']: '_s',  # thumbnail
         MOMENTS_PHOTO_SIZES['medium']: '_m',  # display
     }
+    MOMENTS_ML_PREWARM = True  # connect to Google Vision in the background at startup
 
     SECRET_KEY = os.getenv('SECRET_KEY', 'secret string')
     MAX_CONTENT_LENGTH = 3 * 1024 * 1024  # file size exceed to 3 Mb will return a 413 error response.
@@ -70,6 +71,7 @@ class TestingConfig(BaseConfig):
     TESTING = True
     WTF_CSRF_ENABLED = False
     SQLALCHEMY_DATABASE_URI = 'sqlite:///'  # in-memory database
+    MOMENTS_ML_PREWARM = False
 
 
 class ProductionConfig(BaseConfig):
@@ -0,0 +1,274 @@
+import asyncio
+import io
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from google.cloud import vision
+from PIL import Image
+
+import ml_service
+from ml_service import IndexingError, MLService, _BatchScheduler, fallback_analysis
+
+
+def make_response(request):
+    """Label each image with its own bytes so results can be told apart"""
+    content = request.image.content.decode()
+    if content.startswith('error'):
+        return vision.AnnotateImageResponse(error={'message': f'bad image {content}'})
+    return vision.AnnotateImageResponse(label_annotations=[vision.EntityAnnotation(description=content, score=0.9)])
+
+
+class FakeClient:
+    """Stands in for vision.ImageAnnotatorClient"""
+
+    def __init__(self):
+        self.batch_sizes = []
+        self.annotate_calls = 0
+
+    def annotate_image(self, request):
+        self.annotate_calls += 1
+        return make_response(request)
+
+    def batch_annotate_images(self, requests):
+        self.batch_sizes.append(len(requests))
+        return vision.BatchAnnotateImagesResponse(responses=[make_response(request) for request in requests])
+
+    def async_batch_annotate_images(self, requests, output_config):
+        if any(request.image.source.image_uri.endswith('reject') for request in requests):
+            raise RuntimeError('quota exceeded')
+        return [request.image.source.image_uri for request in requests], output_config.gcs_destination.uri
+
+
+class FakeAsyncClient:
+    """Stands in for vision.ImageAnnotatorAsyncClient, which has no annotate_image helper"""
+
+    def __init__(self):
+        self.batch_sizes = []
+
+    async def batch_annotate_images(self, requests):
+        self.batch_sizes.append(len(requests))
+        await asyncio.sleep(0)
+        return vision.BatchAnnotateImagesResponse(responses=[make_response(request) for request in requests])
+
+
+class MLServiceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.client = FakeClient()
+        patcher = mock.patch.object(ml_service, '_client', self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.service = MLService(cache_dir=None)
+        self.async_client = FakeAsyncClient()
+        patcher = mock.patch.object(MLService, '_get_async_client', return_value=self.async_client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def make_image(self, name, content=None):
+        # Files under PREPARE_MIN_BYTES are sent as-is, so plain bytes work as images
+        path = os.path.join(self.tmp_dir, name)
+        with open(path, 'wb') as f:
+            f.write((content or name).encode())
+        return path
+
+    def alt_text(self, name):
+        return f'Image containing {name}'
+
+    def test_analyze_batch_chunks_by_16(self):
+        paths = [self.make_image(f'img{i}') for i in range(40)]
+        results = self.service.analyze_batch(paths)
+        self.assertEqual(self.client.batch_sizes, [16, 16, 8])
+        for i, path in enumerate(paths):
+            self.assertEqual(results[path]['alt_text'], self.alt_text(f'img{i}'))
+
+    def test_analyze_batch_unreadable_file(self):
+        paths = [self.make_image(f'img{i}') for i in range(3)]
+        missing = os.path.join(self.tmp_dir, 'missing.jpg')
+        results = self.service.analyze_batch(paths + [missing])
+        self.assertEqual(self.client.batch_sizes, [3])
+        self.assertEqual(results[missing], fallback_analysis())
+        for i, path in enumerate(paths):
+            self.assertEqual(results[path]['objects'], [f'img{i}'])
+
+    def test_analyze_batch_image_error(self):
+        good = self.make_image('good')
+        bad = self.make_image('error1')
+        results = self.service.analyze_batch([good, bad])
+        self.assertEqual(results[good]['alt_text'], self.alt_text('good'))
+        self.assertEqual(results[bad], fallback_analysis())
+
+    def test_detailed_analysis_cache_hit(self):
+        path = self.make_image('cat')
+        first = self.service.get_detailed_analysis(path)
+        second = self.service.get_detailed_analysis(path)
+        self.assertEqual(self.client.annotate_calls, 1)
+        self.assertEqual(first, second)
+        self.assertEqual(first['alt_text'], self.alt_text('cat'))
+
+    def test_detailed_analysis_cache_miss_on_new_content(self):
+        self.service.get_detailed_analysis(self.make_image('cat'))
+        self.service.get_detailed_analysis(self.make_image('dog'))
+        self.assertEqual(self.client.annotate_calls, 2)
+
+    def test_cached_result_is_a_copy(self):
+        path = self.make_image('cat')
+        self.service.get_detailed_analysis(path)['objects'].append('mutated')
+        self.assertEqual(self.service.get_detailed_analysis(path)['objects'], ['cat'])
+
+    def test_cache_key_includes_features_and_version(self):
+        labels = [vision.Feature(type_=vision.Feature.Type.LABEL_DETECTION, max_results=10)]
+        fewer_labels = [vision.Feature(type_=vision.Feature.Type.LABEL_DETECTION, max_results=3)]
+        key = self.service._cache_key('abc', labels)
+        self.assertNotEqual(key, self.service._cache_key('abc', fewer_labels))
+        self.assertNotEqual(key, self.service._cache_key('abc', ml_service.DETAILED_FEATURES))
+        with mock.patch.object(ml_service, 'CACHE_VERSION', ml_service.CACHE_VERSION + 1):
+            self.assertNotEqual(key, self.service._cache_key('abc', labels))
+
+    def test_memory_cache_lru_eviction(self):
+        with mock.patch.object(ml_service, 'MEMORY_CACHE_SIZE', 2):
+            self.service._cache_set('a', {'n': 1})
+            self.service._cache_set('b', {'n': 2})
+            self.service._cache_get('a')  # a is now the most recently used
+            self.service._cache_set('c', {'n': 3})
+        self.assertEqual(list(self.service._mem_cache), ['a', 'c'])
+        self.assertIsNone(self.service._cache_get('b'))
+
+    def test_disk_cache_shared_across_instances(self):
+        cache_dir = os.path.join(self.tmp_dir, 'cache')
+        path = self.make_image('cat')
+        MLService(cache_dir=cache_dir).get_detailed_analysis(path)
+        result = MLService(cache_dir=cache_dir).get_detailed_analysis(path)
+        self.assertEqual(self.client.annotate_calls, 1)
+        self.assertEqual(result['alt_text'], self.alt_text('cat'))
+
+    def test_async_stub_matches_real_client(self):
+        self.assertFalse(hasattr(vision.ImageAnnotatorAsyncClient, 'annotate_image'))
+        self.assertTrue(hasattr(vision.ImageAnnotatorAsyncClient, 'batch_annotate_images'))
+
+    def test_analyze_pipeline_results_in_order(self):
+        paths = [self.make_image(f'img{i}') for i in range(20)]
+        results = asyncio.run(self.service.analyze_pipeline(paths))
+        self.assertEqual([result['alt_text'] for result in results], [self.alt_text(f'img{i}') for i in range(20)])
+        self.assertEqual(sum(self.async_client.batch_sizes), 20)
+
+    def test_analyze_pipeline_item_failure(self):
+        paths = [self.make_image(f'img{i}') for i in range(5)]
+        paths[1] = os.path.join(self.tmp_dir, 'missing.jpg')
+        paths[3] = self.make_image('error3')
+        results = asyncio.run(self.service.analyze_pipeline(paths))
+        for i in (1, 3):
+            self.assertEqual(results[i], fallback_analysis())
+        for i in (0, 2, 4):
+            self.assertEqual(results[i]['alt_text'], self.alt_text(f'img{i}'))
+
+    def test_analyze_pipeline_cache_hit_skips_rpc(self):
+        paths = [self.make_image(f'img{i}') for i in range(3)]
+        asyncio.run(self.service.analyze_pipeline(paths))
+        results = asyncio.run(self.service.analyze_pipeline(paths))
+        self.assertEqual(sum(self.async_client.batch_sizes), 3)
+        self.assertEqual(results[2]['alt_text'], self.alt_text('img2'))
+
+    def make_request(self, content):
+        return vision.AnnotateImageRequest(image=vision.Image(content=content.encode()))
+
+    def test_batch_scheduler_splits_and_resolves(self):
+        async def run():
+            scheduler = _BatchScheduler(self.async_client)
+            return await asyncio.gather(*[scheduler.submit(self.make_request(f'img{i}')) for i in range(40)])
+
+        responses = asyncio.run(run())
+        self.assertEqual(self.async_client.batch_sizes, [16, 16, 8])
+        self.assertEqual([r.label_annotations[0].description for r in responses], [f'img{i}' for i in range(40)])
+
+    def test_batch_scheduler_image_error_fails_only_its_caller(self):
+        async def run():
+            scheduler = _BatchScheduler(self.async_client)
+            requests = [self.make_request(name) for name in ('img0', 'error1', 'img2')]
+            return await asyncio.gather(*[scheduler.submit(r) for r in requests], return_exceptions=True)
+
+        responses = asyncio.run(run())
+        self.assertEqual(self.async_client.batch_sizes, [3])
+        self.assertIsInstance(responses[1], RuntimeError)
+        self.assertEqual(responses[0].label_annotations[0].description, 'img0')
+        self.assertEqual(responses[2].label_annotations[0].description, 'img2')
+
+    def test_analyze_many(self):
+        paths = [self.make_image('img0'), self.make_image('error1')]
+        results = asyncio.run(self.service.analyze_many(paths))
+        self.assertEqual(results[0]['alt_text'], self.alt_text('img0'))
+        self.assertEqual(results[1], fallback_analysis())
+
+    def test_resize_content(self):
+        buffer = io.BytesIO()
+        Image.effect_noise((3000, 2000), 64).convert('RGBA').save(buffer, format='PNG')
+        self.assertGreater(len(buffer.getvalue()), ml_service.PREPARE_MIN_BYTES)
+        with Image.open(io.BytesIO(self.service._resize_content(buffer.getvalue()))) as img:
+            self.assertEqual(img.format, 'JPEG')
+            self.assertEqual(img.mode, 'RGB')
+            self.assertEqual(img.size, (1024, 683))
+
+    def test_resize_content_keeps_small_images(self):
+        content = b'small image'
+        self.assertIs(self.service._resize_content(content), content)
+
+    def test_build_client_keeps_unlimited_message_sizes(self):
+        with mock.patch.dict(os.environ, {'GOOGLE_APPLICATION_CREDENTIALS': 'credentials.json'}), \
+                mock.patch.object(ml_service.google.auth, 'default', return_value=(mock.Mock(), 'project')), \
+                mock.patch.object(ml_service, 'ImageAnnotatorGrpcTransport') as transport, \
+                mock.patch.object(vision, 'ImageAnnotatorClient'):
+            ml_service._build_client()
+        options = dict(transport.create_channel.call_args.kwargs['options'])
+        self.assertEqual(options['grpc.max_send_message_length'], -1)
+        self.assertEqual(options['grpc.max_receive_message_length'], -1)
+
+    def test_index_library_gives_each_operation_its_own_prefix(self):
+        uris = [f'gs://photos/{i}.jpg' for i in range(5)]
+        with mock.patch.object(ml_service, 'OFFLINE_BATCH_SIZE', 2):
+            operations = self.service.index_library(uris, 'gs://index/run/')
+        self.assertEqual(
+            operations,
+            [
+                (uris[0:2], 'gs://index/run/batch-1/'),
+                (uris[2:4], 'gs://index/run/batch-2/'),
+                (uris[4:], 'gs://index/run/batch-3/'),
+            ],
+        )
+
+    def test_index_library_reports_unsubmitted_uris(self):
+        uris = ['gs://photos/0.jpg', 'gs://photos/1.jpg', 'gs://photos/reject', 'gs://photos/3.jpg']
+        with mock.patch.object(ml_service, 'OFFLINE_BATCH_SIZE', 2):
+            with self.assertRaises(IndexingError) as cm:
+                self.service.index_library(uris, 'gs://index/run')
+        self.assertEqual(len(cm.exception.operations), 1)
+        self.assertEqual(cm.exception.unsubmitted_uris, uris[2:])
+
+    def test_constructing_service_starts_no_threads(self):
+        with mock.patch.object(ml_service.threading, 'Thread') as thread:
+            MLService(cache_dir=None)
+        thread.assert_not_called()
+
+    def test_warmup_connects_without_sending_requests(self):
+        self.client.transport = mock.Mock()
+        credentials = mock.Mock()
+        with mock.patch.object(ml_service, '_credentials', credentials), \
+                mock.patch.object(ml_service.grpc, 'channel_ready_future') as channel_ready_future:
+            self.service._warmup()
+        credentials.refresh.assert_called_once()
+        channel_ready_future.assert_called_once_with(self.client.transport.grpc_channel)
+        self.assertEqual(self.client.annotate_calls, 0)
+        self.assertEqual(self.client.batch_sizes, [])
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires os.fork')
+    def test_shared_client_reset_after_fork(self):
+        pid = os.fork()
+        if pid == 0:  # child: the parent's client must not be inherited
+            os._exit(0 if ml_service._client is None else 1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+        self.assertIs(ml_service._client, self.client)